@@ -0,0 +1,75 @@
+# coding: utf-8
+"""
+A module for caching results of CDP lookups on disk, across runs of the tools.
+
+Found assets and timeseries are stored in a shelve file together with an expiry
+time, keyed on CDP project, kind of lookup and the key searched for. Lookups
+that found nothing are not cached, since the asset or timeseries can be created
+later. A lock file guards the shelve, so parallel processes can share it.
+"""
+import functools
+import logging
+import os
+import os.path
+import shelve
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows, where we run without locking
+    fcntl = None
+
+CACHE_PATH = os.environ.get("CDP_CACHE_PATH", os.path.expanduser(os.path.join("~", ".cache", "icm2cdp.db")))
+CACHE_TTL = int(os.environ.get("CDP_CACHE_TTL", 24 * 60 * 60))  # Seconds, 0 disables the cache
+logger = logging.getLogger()
+
+
+@contextmanager
+def open_cache():
+    """Open the shelve of cached lookups, locked for this process."""
+    if os.path.dirname(CACHE_PATH):  # Empty when path is a bare filename in current folder
+        os.makedirs(os.path.dirname(CACHE_PATH), exist_ok=True)
+    with open(CACHE_PATH + ".lock", "w") as lock:
+        if fcntl:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            with shelve.open(CACHE_PATH) as db:
+                yield db
+        finally:
+            if fcntl:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def persistent(kind):
+    """Decorate lookup 'func(client, key)' to read through the cache, and store what it finds."""
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(client, key):
+            project = getattr(client, "_project", None)
+            if not CACHE_TTL or not project:
+                return func(client, key)
+
+            cache_key = "{}:{}:{}".format(project, kind, key)
+            try:
+                with open_cache() as db:
+                    value, expiry = db.get(cache_key, (None, 0))
+            except Exception as exc:
+                logger.warning("Failed to read CDP cache {}: {}".format(CACHE_PATH, exc))
+                return func(client, key)
+            if value is not None and expiry > time.time():
+                return value
+
+            value = func(client, key)
+            if value is not None:
+                try:
+                    with open_cache() as db:
+                        db[cache_key] = (value, time.time() + CACHE_TTL)
+                except Exception as exc:
+                    logger.warning("Failed to write CDP cache {}: {}".format(CACHE_PATH, exc))
+            return value
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,52 @@
+# coding: utf-8
+"""
+A module for creating CDP clients that reuse HTTP connections across calls,
+and for sending chunks of data to CDP in parallel with them.
+
+The tools send many small requests to CDP from several threads, so the default
+connection pool of the SDK's requests session is replaced with a larger one,
+to avoid a new TCP and TLS handshake for most calls.
+"""
+import logging
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from cognite import CogniteClient
+from requests.adapters import HTTPAdapter
+
+POOL_SIZE = 32  # Connections kept alive, more than the threads calling CDP in parallel
+logger = logging.getLogger()
+
+
+def create_client(api_key):
+    """Create CogniteClient, with a larger connection pool in its HTTP session."""
+    client = CogniteClient(api_key=api_key)
+    session = getattr(getattr(client, "_api_client", None), "_request_session", None)
+    if session is None:
+        logger.debug("Found no HTTP session in CogniteClient, using default connection pool")
+        return client
+
+    # Keep the retry policy of the SDK's own adapter, only the pool size is changed
+    retries = session.get_adapter("https://").max_retries
+    session.mount("https://", HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE, max_retries=retries))
+    return client
+
+
+def post_chunks(post, chunks, workers):
+    """Call 'post' with each chunk in up to 'workers' parallel threads, and return number of items posted.
+
+    Chunks are only taken from 'chunks' when a thread is free, so a generator never has more than
+    'workers' chunks in memory at once.
+    """
+    count = 0
+    pending = set()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for chunk in chunks:
+            if len(pending) >= workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result()  # Re-raise any exception from the call
+            pending.add(executor.submit(post, chunk))
+            count += len(chunk)
+        for future in pending:
+            future.result()
+    return count
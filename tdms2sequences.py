@@ -9,16 +9,26 @@ import logging
 import os
 import os.path
 import sys
+from collections import ChainMap, defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import date
+from functools import lru_cache, partial
+from itertools import repeat
 
-from cognite import CogniteClient
+import numpy
 from cognite.client.experimental.sequences import Column, Row, RowValue, Sequence
-from cognite.client.stable.datapoints import Datapoint
+from cognite.client.stable.datapoints import Datapoint, TimeseriesWithDatapoints
 from cognite.client.stable.time_series import TimeSeries
 
 from nptdms import TdmsFile
 
+import cdp_cache
+import cdp_client
+
 logger = logging.getLogger()
+worker_client = None  # CogniteClient of worker process, the client can't be pickled to workers
+known_timeseries = set()  # Names of timeseries found or created in CDP by this process
+SEQUENCE_ROWS_LIMIT = int(os.environ.get("SEQUENCE_ROWS_LIMIT", 10000))  # Rows in each call to CDP
 
 
 def parse_cli_args():
@@ -34,6 +44,14 @@ def parse_cli_args():
         action="store_true",
         help="Optional, only process static values, not waveforms",
     )
+    parser.add_argument(
+        "--workers",
+        "-w",
+        type=int,
+        required=False,
+        default=1,
+        help="Optional, number of processes handling files in parallel, default is 1",
+    )
     return parser.parse_args()
 
 
@@ -42,31 +60,58 @@ def find_cdp_asset_id(client, metadata):
     asset_uid = metadata.get("NI_CM_AssetNodeId")
     asset_name = metadata.get("NI_CM_AssetName")
     if not asset_uid:
-        logger.warning("Sequence does not have asset name: {}".format(metadata))
+        logger.warning("Sequence does not have asset name: {}".format(dict(metadata)))
         return
 
-    res = client.assets.get_assets(metadata={"UID": asset_uid}, autopaging=True)
-    match = [i for i in res if i.to_json().get("metadata", {}).get("UID") == asset_uid]
-    if match:
-        id_ = match[0].to_json()["id"]
+    id_ = _lookup_asset_id(client, asset_uid)
+    if id_:
         logger.debug("Asset {} has id {} in CDP".format(asset_name, id_))
         return id_
     else:
         logger.warning("Asset {} not found in CDP".format(asset_name))
 
 
+@lru_cache(maxsize=4096)
+@cdp_cache.persistent("asset")
+def _lookup_asset_id(client, asset_uid):
+    """Search CDP for id of asset with 'asset_uid', cached since many channels share the same asset."""
+    res = client.assets.get_assets(metadata={"UID": asset_uid}, limit=2)  # UID is filtered on exact match in CDP
+    match = [i for i in res if i.to_json().get("metadata", {}).get("UID") == asset_uid]
+    if len(match) > 1:
+        logger.warning("Found multiple assets with UID {} in CDP, using first".format(asset_uid))
+    if match:
+        return match[0].to_json()["id"]
+
+
 def find_cdp_timeseries(client, name):
     """Check if timeseries with the given 'name' already exists in CDP."""
-    res = client.time_series.get_time_series(prefix=name, include_metadata=True, autopaging=True)
-    match = [i for i in res if i.to_json().get("name") == name]
-    if match:
-        found = match[0].to_json()
+    found = _lookup_timeseries(client, name)
+    if found:
         logger.debug("Timeseries {} has id {} in CDP".format(name, found["id"]))
         return found
     else:
         logger.info("Timeseries {} does not exists in CDP".format(name))
 
 
+@lru_cache(maxsize=4096)
+@cdp_cache.persistent("timeseries")
+def _lookup_timeseries(client, name):
+    """Search CDP for timeseries with 'name', cached since many channels map to the same timeseries."""
+    res = client.time_series.get_time_series(prefix=name, include_metadata=True, autopaging=True)
+    match = [i for i in res if i.to_json().get("name") == name]
+    if len(match) > 1:
+        logger.warning("Found multiple timeseries named {} in CDP, using first".format(name))
+    if match:
+        return match[0].to_json()
+
+
+def stringify_dates(metadata):
+    """Convert date and datetime values of 'metadata' to strings in place, as CDP only accepts strings."""
+    date_keys = [k for k, v in metadata.items() if isinstance(v, date)]
+    for k in date_keys:
+        metadata[k] = str(metadata[k])
+
+
 def update_cdp_timeseries(client, name, metadata, asset_name=None, asset_id=None):
     """Insert timeseries metadata into CDP."""
     vargs = {"is_string": False}
@@ -78,12 +123,20 @@ def update_cdp_timeseries(client, name, metadata, asset_name=None, asset_id=None
         vargs["description"] = metadata["NI_CM_Reason"]
     if asset_name:
         metadata["assetName"] = asset_name
-    metadata.update({k: str(v) for k, v in metadata.items() if isinstance(v, date)})
-    client.time_series.post_time_series([TimeSeries(name=name, metadata=metadata, **vargs)])
-
-
-def process_static_data(client, metadata, path):
-    """TDMS can hold a single value for a static group, we send it as datapoints to CDP."""
+    stringify_dates(metadata)
+    try:
+        client.time_series.post_time_series([TimeSeries(name=name, metadata=dict(metadata), **vargs)])
+    except Exception:
+        # Names are unique in CDP, another worker process might have created it since we checked
+        _lookup_timeseries.cache_clear()
+        if not _lookup_timeseries(client, name):
+            raise
+        logger.info("Timeseries {} was created by another process".format(name))
+    _lookup_timeseries.cache_clear()  # Drop cached misses, the timeseries now exists
+
+
+def process_static_data(metadata, path, pending):
+    """TDMS can hold a single value for a static group, we add it to 'pending' datapoints for CDP."""
     timestamp = int(metadata["DateTime"].timestamp() * 1000)
     try:
         value = float(metadata["Value"])
@@ -97,12 +150,34 @@ def process_static_data(client, metadata, path):
         return
 
     name = asset_name.replace(" ", "_")
+    pending[name].append((timestamp, value, metadata))
 
-    if not find_cdp_timeseries(client, name):
-        asset_id = find_cdp_asset_id(client, metadata)
-        update_cdp_timeseries(client, name, metadata, asset_name, asset_id)
 
-    client.datapoints.post_datapoints(name, [Datapoint(timestamp=timestamp, value=value)])
+def post_static_data(client, pending, path):
+    """Create missing timeseries, and send 'pending' datapoints of all timeseries to CDP in one call."""
+    ready = {}
+    for name, points in pending.items():
+        if name not in known_timeseries and not find_cdp_timeseries(client, name):
+            metadata = points[0][2]  # Timeseries gets metadata of first channel with a value for it
+            try:
+                asset_id = find_cdp_asset_id(client, metadata)
+                update_cdp_timeseries(client, name, metadata, metadata.get("NI_CM_AssetName"), asset_id)
+            except Exception as exc:
+                logger.error("{} Failed to create timeseries {}, skipping its values: {}".format(path, name, exc))
+                continue
+        known_timeseries.add(name)
+        ready[name] = points
+    if not ready:
+        return
+
+    client.datapoints.post_multi_time_series_datapoints(
+        [
+            TimeseriesWithDatapoints(name, [Datapoint(timestamp=ts, value=value) for ts, value, _ in points])
+            for name, points in ready.items()
+        ]
+    )
+    count = sum(len(points) for points in ready.values())
+    logger.info("{} Sent {} static values to {} timeseries".format(path, count, len(ready)))
 
 
 def create_sequence(client, channel, metadata):
@@ -111,52 +186,102 @@ def create_sequence(client, channel, metadata):
     asset_id = find_cdp_asset_id(client, metadata)
     time_type = str(channel.time_track(True, "ns").dtype)
     data_type = str(channel.data.dtype)
-    metadata.update({k: str(v) for k, v in metadata.items() if isinstance(v, date)})
+    stringify_dates(metadata)
 
     columns = [Column(name="time", value_type=time_type), Column(name="value", value_type=data_type)]
-    return Sequence(name=name, asset_id=asset_id, columns=columns, description=channel.path, metadata=metadata)
+    return Sequence(name=name, asset_id=asset_id, columns=columns, description=channel.path, metadata=dict(metadata))
+
 
+def create_seq_rows(channel, columns, limit=SEQUENCE_ROWS_LIMIT):
+    """Create the rows, each has timestamp and a value, yielded in chunks of 'limit' rows."""
+    time_id, value_id = columns[0].id, columns[1].id
+    times = channel.time_track(True, "ns")
+    values = channel.data.astype("float64", copy=False)
+    for start in range(0, len(values), limit):
+        chunk_times = numpy.datetime_as_string(times[start : start + limit], unit="ns").tolist()
+        chunk_values = values[start : start + limit].tolist()
+        yield [
+            Row(i, [RowValue(time_id, t), RowValue(value_id, v)])
+            for i, (t, v) in enumerate(zip(chunk_times, chunk_values), start)
+        ]
 
-def create_seq_rows(channel, columns):
-    """Create the rows, each has timestamp and a value."""
-    rows = []
-    iterator = channel.as_dataframe(True).iterrows()
-    next(iterator)  # Skip header
-    for i, row in enumerate(iterator):
-        rows.append(Row(i, [RowValue(columns[0].id, str(row[0])), RowValue(columns[1].id, float(row[1].values[0]))]))
-    return rows
+
+def insert_cdp_sequence_rows(client, sequence_id, chunks, workers=6):
+    """Store each chunk of rows in CDP sequence, with up to 'workers' calls running in parallel."""
+    post = partial(client.experimental.sequences.post_data_to_sequence, sequence_id)
+    count = cdp_client.post_chunks(post, chunks, workers)
+    logger.debug("Sent {} rows to CDP sequence {}".format(count, sequence_id))
+    return count
 
 
 def process_tdms_file(client, tdms, path, only_static=False):
     """Handle all groups of sequence data and static data, and post to CDP."""
-    properties = tdms.object().properties
+    properties = dict(tdms.object().properties)
     channels = [c for group in tdms.groups() for c in tdms.group_channels(group)]
+    pending = defaultdict(list)  # Static datapoints by timeseries name, sent after the channels
 
-    for channel in channels:
-        metadata = dict(properties)
-        metadata.update(channel.properties)
-        metadata["Group"] = channel.group
-        metadata["Channel"] = channel.channel
+    try:
+        for channel in channels:
+            overrides = dict(channel.properties)
+            overrides["Group"] = channel.group
+            overrides["Channel"] = channel.channel
+            metadata = ChainMap(overrides, properties)  # Changes only affect this channel
+
+            if not channel.has_data or channel.data.size == 0:
+                if channel.property("Value") and metadata.get("DateTime"):  # Static value channels
+                    process_static_data(metadata, path, pending)
+                else:
+                    logger.warning("{}: {} channel has no data {}".format(path, channel.path, dict(metadata)))
+                continue
 
-        if not channel.has_data or not channel.data.any():
-            if channel.property("Value") and metadata.get("DateTime"):  # Static value channels
-                process_static_data(client, metadata, path)
+            if only_static:
+                continue
+
+            sequence = create_sequence(client, channel, metadata)
+
+            res = client.experimental.sequences.post_sequences([sequence])
+            if res:
+                count = insert_cdp_sequence_rows(client, res.id, create_seq_rows(channel, res.columns))
+                logger.info("Sent {} rows to sequence {}".format(count, res.name))
             else:
-                logger.warning("{}: {} channel has no data {}".format(path, channel.path, metadata))
-            continue
+                logger.error("{} Failed to create sequence {}".format(path, sequence.name))
+    finally:  # Send static values found so far, even if a waveform failed
+        if pending:
+            post_static_data(client, pending, path)
 
-        if only_static:
-            continue
 
-        sequence = create_sequence(client, channel, metadata)
+def parse_tdms_file(path):
+    """Read and parse the TDMS file at 'path'."""
+    with open(path, "rb") as fp:
+        return TdmsFile(fp)
 
-        res = client.experimental.sequences.post_sequences([sequence])
-        if res:
-            rows = create_seq_rows(channel, res.columns)
-            client.experimental.sequences.post_data_to_sequence(res.id, rows)
-            logger.info("Sent {} rows to sequence {}".format(len(rows), res.name))
-        else:
-            logger.error("{} Failed to create sequence {}".format(path, sequence.name))
+
+def process_tdms_files(client, files, only_static=False):
+    """Process 'files' one by one, while parsing the next file in the background."""
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        prefetch = executor.submit(parse_tdms_file, files[0]) if files else None
+        for i, path in enumerate(files):
+            try:
+                tdms = prefetch.result()
+            except Exception as exc:
+                logger.error("Fatal: failed to parse TDMS file {}: {}".format(path, exc))
+                tdms = None
+            if i + 1 < len(files):
+                prefetch = executor.submit(parse_tdms_file, files[i + 1])
+            if tdms is not None:
+                process_tdms_file(client, tdms, path, only_static)
+
+
+def init_worker(api_key):
+    """Set up logging and CDP client in a new worker process."""
+    global worker_client
+    logging.basicConfig(level=logging.INFO)
+    worker_client = cdp_client.create_client(api_key)
+
+
+def process_tdms_files_in_worker(files, only_static=False):
+    """Process 'files' one by one in a worker process, also parsing the next file in the background."""
+    process_tdms_files(worker_client, files, only_static)
 
 
 def main(args):
@@ -170,17 +295,15 @@ def main(args):
         logger.fatal("--path must point to either folder or tdms file: {}".format(args.path))
         sys.exit(2)
 
-    client = CogniteClient(api_key=args.apikey if args.apikey else os.environ.get("COGNITE_API_KEY"))
+    api_key = args.apikey if args.apikey else os.environ.get("COGNITE_API_KEY")
 
-    for path in files:
-        with open(path, "rb") as fp:
-            try:
-                tdms = TdmsFile(fp)
-            except Exception as exc:
-                logger.error("Fatal: failed to parse TDMS file {}: {}".format(path, exc))
-                continue
-            else:
-                process_tdms_file(client, tdms, path, args.only_static)
+    workers = min(args.workers or 1, len(files))
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(api_key,)) as executor:
+            batches = [files[i::workers] for i in range(workers)]  # Files dealt out round-robin to workers
+            list(executor.map(process_tdms_files_in_worker, batches, repeat(args.only_static)))
+    else:
+        process_tdms_files(cdp_client.create_client(api_key), files, args.only_static)
 
 
 if __name__ == "__main__":
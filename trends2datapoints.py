@@ -7,32 +7,43 @@ for storing it in Cognite Data Platform (CDP).
 Trend data should be in zip files that contain MetaData.json, Assets.json,
 and chartdata.xlsx.
 
-The module will unzip it to a temp folder, extract asset and metadata from
-json files. It will get timestamps and values from excel file. Next it will
-check if asset exists, and if timeseries exists. If no timeseries exists it
-will save metadata. Finally it posts all datapoints to CDP.
+The module will read the files straight from the zip, extract asset and
+metadata from json files. It will get timestamps and values from excel file.
+Next it will check if asset exists, and if timeseries exists. If no timeseries
+exists it will save metadata. Finally it posts all datapoints to CDP.
 """
 import argparse
+import codecs
 import glob
-import json
+import io
 import logging
 import os
 import os.path
 import sys
 import zipfile
 from collections import namedtuple
-from tempfile import TemporaryDirectory
+from functools import partial
 
+import numpy
 import pandas
-from cognite import CogniteClient
 from cognite.client.stable.datapoints import Datapoint
 from cognite.client.stable.time_series import TimeSeries
 
-# import xlrd  # To have pandas parse excel file
+try:
+    from orjson import loads as json_loads  # Optional, faster parsing of large json files
+except ImportError:
+    from json import loads as json_loads
+
+import cdp_cache
+import cdp_client
 
 
 TimeData = namedtuple("TimeData", ["name", "trendId", "assetId", "assetName", "metadata"])
 logger = logging.getLogger()
+# Engines for pandas to parse excel file, in order of preference. Calamine and openpyxl are optional,
+# they are used when installed with a pandas version that supports them, otherwise xlrd is used.
+EXCEL_ENGINES = ("calamine", "openpyxl", "xlrd")
+MAX_WORKERS = 8  # Calls sending datapoints to CDP in parallel
 
 
 def parse_cli_args():
@@ -51,27 +62,30 @@ def parse_cli_args():
     return parser.parse_args()
 
 
-def process_timeseries_metadata(path_to_assets, path_to_metadata):
-    """Find asset and timeseries metadata from json files."""
-    if not path_to_assets or not path_to_metadata:
-        logger.error("Missing paths to assets or metadata {} {}".format(path_to_assets, path_to_metadata))
+def load_json(content):
+    """Parse json document from bytes, skipping any UTF-8 BOM which orjson doesn't accept."""
+    if content.startswith(codecs.BOM_UTF8):
+        content = content[len(codecs.BOM_UTF8) :]
+    return json_loads(content)
+
+
+def process_timeseries_metadata(assets, meta, path):
+    """Find asset and timeseries metadata from content of json files in 'path'."""
+    if assets is None or meta is None:
+        logger.error("Missing assets or metadata json file in {}".format(path))
         return
 
     # Find trend id to map to right timeseries and asset
-    with open(path_to_metadata) as fp:
-        meta = json.load(fp)
     trend_id = None
     if meta and "Instructions" in meta[0] and meta[0]["Instructions"]:
         trend_id = meta[0]["Instructions"][0].get("Props", {}).get("TrendPointId")
     if not trend_id:
-        logger.error("Can't find TrendPointId in {} {}".format(path_to_metadata, meta))
+        logger.error("Can't find TrendPointId in {} {}".format(path, meta))
         return
 
     # Find asset and timeseries with metadata
-    with open(path_to_assets) as fp:
-        assets = json.load(fp)
     if not assets or "FullName" not in assets[0] or "Id" not in assets[0]:
-        logger.error("Can't find require info in {} {}".format(path_to_assets, assets))
+        logger.error("Can't find require info in {} {}".format(path, assets))
         return
     asset_id = assets[0]["Id"]
     asset_name = assets[0]["FullName"]
@@ -80,7 +94,7 @@ def process_timeseries_metadata(path_to_assets, path_to_metadata):
     if "Metrics" in assets[0] and assets[0]["Metrics"]:
         trends = [i for i in assets[0]["Metrics"] if i.get("Id") == trend_id]
         if not trends:
-            logger.error("Unknown timeseries/trend {} {} in {}".format(trend_id, assets[0], path_to_metadata))
+            logger.error("Unknown timeseries/trend {} {} in {}".format(trend_id, assets[0], path))
             return
         properties.update(trends[0])
 
@@ -92,51 +106,81 @@ def process_timeseries_metadata(path_to_assets, path_to_metadata):
     return TimeData(name, trend_id, asset_id, asset_name, properties)
 
 
-def process_datapoints_excel_file(path):
-    """Extract timestamp and values from 'path'."""
-    with open(path, "rb") as fp:
-        data = pandas.read_excel(fp, skiprows=[0, 1])
-
-    points = []
-    for i, row in data.iterrows():
-        panda_ts, value_str = row[0], row[1]
+def read_excel_file(fp, path):
+    """Read timestamp and value columns from excel file, with the fastest engine available."""
+    for engine in EXCEL_ENGINES:
         try:
-            value = float(value_str)
-        except ValueError as exc:
-            logger.warning("Failed to convert float {} {}".format(value_str, exc))
-            continue
-        timestamp = panda_ts.value // 10 ** 6  # From nano to microseconds
-        points.append((timestamp, value))
-
-    if not points:
+            return pandas.read_excel(fp, skiprows=[0, 1], usecols=[0, 1], engine=engine)
+        except Exception as exc:  # Engine not installed, not supported by pandas, or failed to parse
+            logger.debug("Failed to read excel in {} with {}: {}".format(path, engine, exc))
+            fp.seek(0)
+    logger.error("Failed to read excel file in {} with any of {}".format(path, ", ".join(EXCEL_ENGINES)))
+
+
+def process_datapoints_excel_file(content, path):
+    """Extract values indexed by timestamp from excel file 'content' in 'path'."""
+    if content is None:
+        logger.error("Missing excel file in {}".format(path))
+        return pandas.Series(dtype="float64")
+    data = read_excel_file(io.BytesIO(content), path)
+    if data is None:
+        return pandas.Series(dtype="float64")
+
+    timestamps = data.iloc[:, 0].values.astype("datetime64[ns]").view("int64") // 10 ** 6  # From nano to milliseconds
+    values = pandas.to_numeric(data.iloc[:, 1], errors="coerce").values
+    valid = ~numpy.isnan(values)
+    if not valid.all():
+        logger.warning("Failed to convert {} values to float in {}".format((~valid).sum(), path))
+
+    points = pandas.Series(values[valid], index=timestamps[valid])
+
+    if points.empty:
         logger.error("No valid datapoints found in file {}".format(path))
     return points
 
 
 def find_cdp_asset(client, asset_uid, asset_name):
     """Search for CDP asset with UID that matches 'asset_uid'."""
-    res = client.assets.get_assets(metadata={"UID": asset_uid}, autopaging=True)
-    match = [i for i in res if i.to_json().get("metadata", {}).get("UID") == asset_uid]
-    if match:
-        id_ = match[0].to_json()["id"]
+    id_ = _lookup_asset_id(client, asset_uid)
+    if id_:
         logger.debug("Asset {} has id {} in CDP".format(asset_name, id_))
         return id_
     else:
         logger.warning("Asset {} not found in CDP".format(asset_name))
 
 
+@cdp_cache.persistent("asset")
+def _lookup_asset_id(client, asset_uid):
+    """Search CDP for id of asset with 'asset_uid'."""
+    res = client.assets.get_assets(metadata={"UID": asset_uid}, limit=2)  # UID is filtered on exact match in CDP
+    match = [i for i in res if i.to_json().get("metadata", {}).get("UID") == asset_uid]
+    if len(match) > 1:
+        logger.warning("Found multiple assets with UID {} in CDP, using first".format(asset_uid))
+    if match:
+        return match[0].to_json()["id"]
+
+
 def find_cdp_timeseries(client, name):
     """Check if timeseries with the given 'name' already exists in CDP."""
-    res = client.time_series.get_time_series(prefix=name, include_metadata=True, autopaging=True)
-    match = [i for i in res if i.to_json().get("name") == name]
-    if match:
-        found = match[0].to_json()
+    found = _lookup_timeseries(client, name)
+    if found:
         logger.debug("Timeseries {} has id {} in CDP".format(name, found["id"]))
         return found
     else:
         logger.info("Timeseries {} does not exists in CDP".format(name))
 
 
+@cdp_cache.persistent("timeseries")
+def _lookup_timeseries(client, name):
+    """Search CDP for timeseries with 'name'."""
+    res = client.time_series.get_time_series(prefix=name, include_metadata=True, autopaging=True)
+    match = [i for i in res if i.to_json().get("name") == name]
+    if len(match) > 1:
+        logger.warning("Found multiple timeseries named {} in CDP, using first".format(name))
+    if match:
+        return match[0].to_json()
+
+
 def update_cdp_timeseries(client, name, metadata, asset_name=None, asset_id=None):
     """Insert timeseries metadata into CDP."""
     vargs = {"is_string": False}
@@ -151,43 +195,44 @@ def update_cdp_timeseries(client, name, metadata, asset_name=None, asset_id=None
     client.time_series.post_time_series([TimeSeries(name=name, metadata=metadata, **vargs)])
 
 
-def insert_cdp_datapoints(client, name, datapoints, limit=10000):
-    """Store datapoints in CDP, 'limit' amount in each call."""
-    if len(datapoints) > limit:
-        insert_cdp_datapoints(client, name, datapoints[limit:])
-    objs = [Datapoint(timestamp=ts, value=value) for ts, value in datapoints[:limit]]
-    logger.debug("Sending {} to CDP {}".format(len(datapoints), name))
-    client.datapoints.post_datapoints(name, objs)
+def iter_datapoints(points, limit=10000):
+    """Yield 'points' as lists of at most 'limit' Datapoint objects, created only when needed."""
+    for i in range(0, len(points), limit):
+        chunk = points.iloc[i : i + limit]
+        yield [Datapoint(timestamp=ts, value=value) for ts, value in zip(chunk.index.tolist(), chunk.tolist())]
+
+
+def insert_cdp_datapoints(client, name, chunks):
+    """Store each chunk of datapoints in CDP, with the calls running in parallel."""
+    count = cdp_client.post_chunks(partial(client.datapoints.post_datapoints, name), chunks, MAX_WORKERS)
+    logger.debug("Sent {} datapoints to CDP {}".format(count, name))
 
 
 def process_inputs(input_path, save_files=False):
-    """Unzip file, and processed documents inside zip."""
-
-    def match_path(paths, filename):
-        """Case in-sensitive finding filename in list of paths."""
-        for path in paths:
-            if os.path.basename(path).lower() == filename.lower():
-                return path
-
-    def process(output_path):
-        with zipfile.ZipFile(input_path) as zp:
-            zp.extractall(output_path)
-            files = [os.path.join(output_path, i) for i in zp.namelist()]
-
-        timeseries = process_timeseries_metadata(match_path(files, "assets.json"), match_path(files, "metadata.json"))
-        datapoints = process_datapoints_excel_file(match_path(files, "chartdata.xlsx"))
-        return timeseries, datapoints
-
-    base_path, prefix = os.path.split(input_path)
-    prefix = os.path.splitext(prefix)[0]
-    if save_files:
-        real_path = os.path.join(base_path, prefix)
-        if not os.path.exists(real_path):
-            os.makedirs(real_path)
-        return process(real_path)
-    else:
-        with TemporaryDirectory(prefix=prefix, dir=base_path) as tmp_path:
-            return process(tmp_path)
+    """Process documents inside zip file, and extract them next to it if 'save_files'."""
+    with zipfile.ZipFile(input_path) as zp:
+        if save_files:
+            zp.extractall(os.path.splitext(input_path)[0])
+
+        files = {}  # Lowercase filename to path in zip, for case in-sensitive lookup
+        for path in zp.namelist():
+            filename = os.path.basename(path).lower()
+            if not filename:  # Folder entry
+                continue
+            if filename in files:
+                logger.warning("Duplicate {} in {}, using {}".format(path, input_path, files[filename]))
+            else:
+                files[filename] = path
+
+        def read_json(filename):
+            return load_json(zp.read(files[filename])) if filename in files else None
+
+        def read(filename):
+            return zp.read(files[filename]) if filename in files else None
+
+        timeseries = process_timeseries_metadata(read_json("assets.json"), read_json("metadata.json"), input_path)
+        datapoints = process_datapoints_excel_file(read("chartdata.xlsx"), input_path)
+    return timeseries, datapoints
 
 
 def process_datapoints(client, timeseries, datapoints, path):
@@ -196,7 +241,7 @@ def process_datapoints(client, timeseries, datapoints, path):
         cdp_asset_id = find_cdp_asset(client, timeseries.assetId, timeseries.assetName)
         update_cdp_timeseries(client, timeseries.name, timeseries.metadata, timeseries.assetName, cdp_asset_id)
 
-    insert_cdp_datapoints(client, timeseries.name, datapoints)
+    insert_cdp_datapoints(client, timeseries.name, iter_datapoints(datapoints))
     logger.info("Finished processing {} datapoints from {}".format(len(datapoints), path))
 
 
@@ -211,11 +256,11 @@ def main(args):
         logger.fatal("--path must point to either folder or trend zip file: {}".format(args.path))
         sys.exit(2)
 
-    client = CogniteClient(api_key=args.apikey if args.apikey else os.environ.get("COGNITE_API_KEY"))
+    client = cdp_client.create_client(args.apikey if args.apikey else os.environ.get("COGNITE_API_KEY"))
 
     for path in files:
         timeseries, datapoints = process_inputs(path, save_files=args.save_files)
-        if timeseries and datapoints:
+        if timeseries and len(datapoints):
             process_datapoints(client, timeseries, datapoints, path)
 
 